@@ -475,9 +475,9 @@ def get_search_o1_reflection_instruction_v2(
         "2) Do NOT output both A and B.\n"
         "3) Do NOT output multiple queries.\n"
         "4) If you propose a new query, make it more targeted than the last query.\n\n"
-        f"Remaining search budget: {remaining_searches}\n\n"
         "Question:\n"
         f"{question}\n\n"
+        f"Remaining search budget: {remaining_searches}\n\n"
         "Current reasoning / draft:\n"
         f"{current_reasoning}\n\n"
         "Last search query:\n"
@@ -1,10 +1,30 @@
+import io
+import json
+import re
+from functools import lru_cache
+
 from vllm import SamplingParams
+from vllm.sampling_params import GuidedDecodingParams
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+from prompts import get_search_o1_reflection_instruction_v2
+
+BEGIN_SEARCH_QUERY = "<|begin_search_query|>"
+END_SEARCH_QUERY = "<|end_search_query|>"
+_BOXED = "\\boxed{"
+_NON_SPACE = re.compile(r"\S")
 
 # ===========================
 #        PROMPTS
 # ===========================
 
-JUDGE_SNIPPET_PROMPT = """
+def _fmt_judge_snippet(question, query, snippets):
+    return f"""
 You are a relevance evaluator.
 User Question: {question}
 Search Query Used: {query}
@@ -19,7 +39,8 @@ Example of NO: "JUDGEMENT: NO | Reason: The results are about fruit apple, but t
 """
 
 #### FOR REFLECTION
-REFLECTION_QUERY_PROMPT = """
+def _fmt_reflection_query(question, query, reason):
+    return f"""
 The previous search query failed.
 User Question: {question}
 Failed Query: {query}
@@ -32,8 +53,44 @@ New_Query: [The new query string]
 """
 #### FOR REFLECTION
 
+#### FUSED: Gate 1 judge + reflector in one call
+def _fmt_judge_snippet_reflect(question, query, snippets):
+    return f"""
+You are a relevance evaluator.
+User Question: {question}
+Search Query Used: {query}
+Search Results (Snippets):
+{snippets}
+
+Task: Do these snippets appear RELEVANT and helpful for the search query?
+- If YES, set "judgement" to "YES" and leave "reason" and "new_query" empty.
+- If NO, set "judgement" to "NO", explain briefly in "reason" why it failed, and write a NEW,
+  better search query that specifically addresses that reason in "new_query".
+
+Output JSON: {{"judgement": "YES" | "NO", "reason": "...", "new_query": "..."}}
+"""
+
+JUDGE_SNIPPET_REFLECT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "judgement": {"enum": ["YES", "NO"]},
+        "reason": {"type": "string", "maxLength": 200},
+        "new_query": {"type": "string", "maxLength": 200},
+    },
+    "required": ["judgement", "reason", "new_query"],
+    "additionalProperties": False,
+}
+
+def _json_token_budget(schema):
+    # Longest valid output: the skeleton with the longest enum values plus every string at its
+    # maxLength, doubled to cover escapes and characters that take more than one token.
+    props = schema["properties"]
+    skeleton = json.dumps({k: max(v.get("enum", [""]), key=len) for k, v in props.items()})
+    return 2 * (len(skeleton) + sum(v.get("maxLength", 0) for v in props.values()))
 
-PRESENCE_CHECK_PROMPT = """
+
+def _fmt_presence_check(search_query, document_text):
+    return f"""
 You are a Fact Validator.
 User Query: "{search_query}"
 Search Results:
@@ -44,7 +101,8 @@ Task: Determine if the answer to the query is present ANYWHERE in these search r
 - If the text is irrelevant or does not contain the answer, output "STATUS: ABSENT".
 """
 
-REFINE_EXTRACTION_PROMPT = """
+def _fmt_refine_extraction(search_query, document_text):
+    return f"""
 You previously missed the information in these documents.
 User Query: "{search_query}"
 Search Results:
@@ -57,7 +115,8 @@ Task: Read the results again carefully and extract the EXACT answer to the query
 - If you still cannot find it (despite the note), output "No helpful information found."
 """
 
-JUDGE_CONTENT_PROMPT = """
+def _fmt_judge_content(search_query, history, info):
+    return f"""
 You are evaluating if a search result was successful.
 
 Search Query Used: {search_query}
@@ -76,7 +135,8 @@ or
 "JUDGEMENT: NO | Reason: [Explain exactly what is missing]"
 """
 
-REFLECTION_CONTENT_PROMPT = """
+def _fmt_reflection_content(question, search_query, reason, info):
+    return f"""
 The extracted information was judged as INSUFFICIENT to answer the search query.
 User Question: {question}
 Search Query: {search_query}
@@ -92,7 +152,8 @@ Analysis: [What is missing]
 Search_Direction: [Strategic advice for the next step]
 """
 
-HALLUCINATION_CHECK_PROMPT = """
+def _fmt_hallucination_check(question, final_answer):
+    return f"""
 You are a Fact Checker.
 User Question: {question}
 Proposed Final Answer: {final_answer}
@@ -105,129 +166,543 @@ Output exactly: "JUDGEMENT: YES" or "JUDGEMENT: NO"
 """
 
 # ===========================
-#    LOGIC FUNCTIONS
+#        HELPERS
 # ===========================
 
-def run_judge_snippet(llm, tokenizer, question, history, query, results):
-    """Gate 1: Checks search snippet relevance."""
+def _extract_between(text, start_tag, end_tag):
+    """Returns the LAST span between start_tag and end_tag, or None."""
+    # Tags are literal strings, so two rfind scans replace a DOTALL regex findall.
+    j = text.rfind(end_tag)
+    if j < 0:
+        return None
+    i = text.rfind(start_tag, 0, j)
+    if i < 0:
+        return None
+    return text[i + len(start_tag):j].strip()
+
+def _extract_boxed(text):
+    """Returns the content of the last \\boxed{...} (nested braces allowed), or None."""
+    i = text.rfind(_BOXED)
+    if i < 0:
+        return None
+    start = i + len(_BOXED)
+    depth = 1
+    for j in range(start, len(text)):
+        c = text[j]
+        if c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:j].strip()
+    return None
+
+def _build_results_preview(search_results, max_chars=1500):
+    """Renders a few search results (title/snippet/url) as a short text block."""
+    # Same text as "\n\n".join(blocks).strip()[:max_chars], but written against a shrinking
+    # budget so nothing past max_chars is ever built. The text always starts with "[1]", so
+    # only the trailing strip matters: whitespace at the cut survives iff more text follows.
+    out = io.StringIO()
+    remaining = max_chars
+    for i, it in enumerate(search_results or []):
+        if remaining <= 0:
+            return out.getvalue()  # this block's "[i]" is text after the cut
+        try:
+            get = it.get  # results are dicts (extract_relevant_info); anything else is stringified
+            title, snippet, url = str(get("title", "")), str(get("snippet", "")), str(get("url", ""))
+        except (AttributeError, TypeError):
+            title, snippet, url = "", str(it), ""
+        sep = "\n\n" if i else ""
+        for piece in (f"{sep}[{i + 1}] ", title, "\n", snippet, "\n", url):
+            if remaining <= 0:
+                if _NON_SPACE.search(piece):
+                    return out.getvalue()
+                continue
+            written = out.write(piece[:remaining])
+            remaining -= written
+            if remaining <= 0 and _NON_SPACE.search(piece, written):
+                return out.getvalue()
+    return out.getvalue().rstrip()
+
+# Document budgets in tokens (previously ~30k / ~35k chars)
+PRESENCE_MAX_DOC_TOKENS = 7500
+REFINE_MAX_DOC_TOKENS = 8750
+
+@lru_cache(maxsize=16)
+def _encode_document(tokenizer, text):
+    # presence_check and refine_extraction usually get the same document back to back
+    return tuple(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+def _truncate_tokens(tokenizer, text, max_tokens):
+    """Keeps the first max_tokens tokens of text; only a cut document is decoded back."""
+    ids = _encode_document(tokenizer, text)
+    if len(ids) <= max_tokens:
+        return text
+    return tokenizer.decode(ids[:max_tokens], skip_special_tokens=True)
+
+# Whitespace-padded so templates that transform the content (e.g. Llama-3's "| trim") are caught:
+# the splice is only used when the padded sentinel comes back verbatim.
+_CHAT_SENTINEL = "\n \x00CONTENT\x00 \n"
+_CHAT_TEMPLATES = {}  # id(tokenizer) -> (prefix, suffix), or None if the template can't be split
+
+def _chat(tokenizer, prompt_content):
+    """Single-user-turn chat prompt; the Jinja template is rendered once per tokenizer."""
+    key = id(tokenizer)
+    if key not in _CHAT_TEMPLATES:
+        messages = [{"role": "user", "content": _CHAT_SENTINEL}]
+        rendered = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        prefix, _, suffix = rendered.partition(_CHAT_SENTINEL)
+        _CHAT_TEMPLATES[key] = (prefix, suffix) if rendered.count(_CHAT_SENTINEL) == 1 else None
+    template = _CHAT_TEMPLATES[key]
+    if template is None:
+        messages = [{"role": "user", "content": prompt_content}]
+        return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    return template[0] + prompt_content + template[1]
+
+# ===========================
+#   STAGES (prompt / params / parse)
+# ===========================
+
+def _prompt_judge_snippet(tokenizer, question, history, query, results):
     snippets = "\n".join([f"- {r.get('snippet', '')[:150]}" for r in results[:5]])
-    history_short = history[-500:] if history else ""
-    
-    prompt_content = JUDGE_SNIPPET_PROMPT.format(
-        question=question, history=history_short, query=query, snippets=snippets
-    )
-    
-    messages = [{"role": "user", "content": prompt_content}]
-    text_input = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    
-    output = llm.generate([text_input], sampling_params=SamplingParams(max_tokens=500, temperature=0.1))
-    response = output[0].outputs[0].text
-    
-    if "JUDGEMENT: YES" in response:
+    return _fmt_judge_snippet(question=question, query=query, snippets=snippets)
+
+def _parse_judge_snippet(response, verdict=None):
+    if verdict is None:
+        verdict = "JUDGEMENT: YES" in response
+    if verdict:
         return True, None
-    elif "JUDGEMENT: NO" in response:
-        try: reason = response.split("| Reason:")[1].strip()
-        except: reason = "Results appeared irrelevant."
+    else:
+        _, sep, after = response.partition("| Reason:")
+        reason = after.split("\n", 1)[0].strip() if sep else "Results appeared irrelevant."
         return False, reason
-    return True, None 
 
-def run_reflection_query(llm, tokenizer, question, history, failed_query, failure_reason):
-    """Gate 1 Reflector: Generates new query."""
-    history_short = history[-500:] if history else ""
-    prompt_content = REFLECTION_QUERY_PROMPT.format(
-        question=question, history=history_short, query=failed_query, reason=failure_reason
-    )
-    
-    messages = [{"role": "user", "content": prompt_content}]
-    text_input = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    
-    output = llm.generate([text_input], sampling_params=SamplingParams(max_tokens=100, temperature=0.7))
-    response = output[0].outputs[0].text
-    
-    if "New_Query:" in response:
-        try: return response.split("New_Query:")[1].strip().split('\n')[0]
-        except: return None
+def _prompt_reflection_query(tokenizer, question, history, failed_query, failure_reason):
+    return _fmt_reflection_query(question=question, query=failed_query, reason=failure_reason)
+
+def _parse_reflection_query(response):
+    _, sep, after = response.partition("New_Query:")
+    if sep:
+        return after.strip().split("\n", 1)[0]
     return None
 
-def run_presence_check(llm, tokenizer, search_query, document_text):
-    """Checks if info exists in the batch of docs (Boolean check)."""
-    # Truncate to ~30k chars (approx 7-8k tokens) to fit in context while covering most docs
-    short_doc = document_text[:30000] 
-    prompt_content = PRESENCE_CHECK_PROMPT.format(
-        search_query=search_query, 
+def _prompt_judge_snippet_reflect(tokenizer, question, history, query, results):
+    snippets = "\n".join([f"- {r.get('snippet', '')[:150]}" for r in results[:5]])
+    return _fmt_judge_snippet_reflect(question=question, query=query, snippets=snippets)
+
+def _parse_judge_snippet_reflect(response):
+    # Guided JSON keeps the schema's field order, so a YES is decided without parsing the JSON.
+    _, sep, after = response.partition('"judgement":')
+    if sep and after.lstrip().startswith('"YES"'):
+        return True, None, None
+    try:
+        out = _json_loads(response)
+    except ValueError:
+        # Unparseable is not a pass; treat it like an unexplained NO.
+        print(f"Fused snippet judge returned invalid JSON: {response[:200]!r}")
+        return False, "Results appeared irrelevant.", None
+    if out.get("judgement") == "YES":
+        return True, None, None
+    return False, out.get("reason") or "Results appeared irrelevant.", out.get("new_query") or None
+
+def _prompt_presence_check(tokenizer, search_query, document_text):
+    # Truncate to 7.5k tokens to fit in context while covering most docs
+    short_doc = _truncate_tokens(tokenizer, document_text, PRESENCE_MAX_DOC_TOKENS)
+    return _fmt_presence_check(
+        search_query=search_query,
         document_text=short_doc
     )
-    
-    messages = [{"role": "user", "content": prompt_content}]
-    text_input = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    
-    output = llm.generate([text_input], sampling_params=SamplingParams(max_tokens=10, temperature=0.1))
-    response = output[0].outputs[0].text
-    
+
+def _parse_presence_check(response, verdict=None):
+    if verdict is not None:
+        return verdict
     return "STATUS: PRESENT" in response
 
-def run_refine_extraction(llm, tokenizer, search_query, document_text):
-    """Forces a re-read of the documents."""
-    # Use a larger window (35k chars) to ensure we see all 10 snippets
-    prompt_content = REFINE_EXTRACTION_PROMPT.format(
-        search_query=search_query, 
-        document_text=document_text[:35000] 
+def _prompt_refine_extraction(tokenizer, search_query, document_text):
+    # Use a larger window to ensure we see all 10 snippets
+    return _fmt_refine_extraction(
+        search_query=search_query,
+        document_text=_truncate_tokens(tokenizer, document_text, REFINE_MAX_DOC_TOKENS)
     )
-    
-    messages = [{"role": "user", "content": prompt_content}]
-    text_input = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    
-    # Increase max_tokens slightly to allow for a full explanation
-    output = llm.generate([text_input], sampling_params=SamplingParams(max_tokens=1500, temperature=0.5))
-    return output[0].outputs[0].text
 
-def run_judge_content(llm, tokenizer, question, search_query, history, extracted_info):
-    """Gate 2: Checks content sufficiency."""
+def _parse_refine_extraction(response):
+    return response
+
+def _prompt_judge_content(tokenizer, question, search_query, history, extracted_info):
     history_short = history[-500:] if history else ""
-    prompt_content = JUDGE_CONTENT_PROMPT.format(
-        search_query=search_query, 
-        history=history_short, 
+    return _fmt_judge_content(
+        search_query=search_query,
+        history=history_short,
         info=extracted_info[:2000]
     )
-    
-    messages = [{"role": "user", "content": prompt_content}]
-    text_input = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    
-    output = llm.generate([text_input], sampling_params=SamplingParams(max_tokens=100, temperature=0.1))
-    response = output[0].outputs[0].text
-    
-    if "JUDGEMENT: YES" in response:
+
+def _parse_judge_content(response, verdict=None):
+    if verdict is None:
+        verdict = "JUDGEMENT: YES" in response
+    if verdict:
         return True, None
     else:
-        try: reason = response.split("| Reason:")[1].strip()
-        except: reason = "Information was too vague or incomplete."
+        _, sep, after = response.partition("| Reason:")
+        reason = after.split("\n", 1)[0].strip() if sep else "Information was too vague or incomplete."
         return False, reason
 
-def run_reflection_content(llm, tokenizer, question, search_query, extracted_info, failure_reason):
-    """Gate 2 Reflector: Generates search direction."""
-    prompt_content = REFLECTION_CONTENT_PROMPT.format(
-        question=question, 
+def _prompt_reflection_content(tokenizer, question, search_query, extracted_info, failure_reason):
+    return _fmt_reflection_content(
+        question=question,
         search_query=search_query,
-        info=extracted_info[:1000], 
+        info=extracted_info[:1000],
         reason=failure_reason
     )
-    
-    messages = [{"role": "user", "content": prompt_content}]
-    text_input = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    
-    output = llm.generate([text_input], sampling_params=SamplingParams(max_tokens=300, temperature=0.7))
-    return output[0].outputs[0].text.strip()
 
-def run_hallucination_check(llm, tokenizer, question, final_answer):
-    """Post-Hoc Check: Checks for uncited claims."""
-    prompt_content = HALLUCINATION_CHECK_PROMPT.format(
+def _parse_reflection_content(response):
+    return response.strip()
+
+def _prompt_hallucination_check(tokenizer, question, final_answer):
+    return _fmt_hallucination_check(
         question=question, final_answer=final_answer[:2000]
     )
-    
-    messages = [{"role": "user", "content": prompt_content}]
-    text_input = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    
-    output = llm.generate([text_input], sampling_params=SamplingParams(max_tokens=50, temperature=0.1))
-    response = output[0].outputs[0].text
-    
-    return "JUDGEMENT: YES" in response
\ No newline at end of file
+
+def _parse_hallucination_check(response, verdict=None):
+    if verdict is not None:
+        return verdict
+    return "JUDGEMENT: YES" in response
+
+def _prompt_reflection(tokenizer, question, current_reasoning, judge_prompt, last_search_query,
+                       search_results_preview, remaining_searches):
+    return get_search_o1_reflection_instruction_v2(
+        question=question,
+        current_reasoning=current_reasoning,
+        judge_prompt=judge_prompt,
+        last_search_query=last_search_query,
+        search_results_preview=_build_results_preview(search_results_preview),
+        remaining_searches=remaining_searches,
+    )
+
+def _parse_reflection(response, last_search_query):
+    new_q = _extract_between(response, BEGIN_SEARCH_QUERY, END_SEARCH_QUERY)
+    return {
+        "new_query": new_q if new_q and new_q != last_search_query else None,
+        "boxed_answer": _extract_boxed(response),
+        "raw_output": response,
+    }
+
+def _pick_query(candidates, failed_query, max_len=200):
+    """Picks one of n sampled queries: drop empty/too long/unchanged ones, then majority, then shortest."""
+    failed = (failed_query or "").strip().lower()
+    counts = {}
+    for q in candidates:
+        q = (q or "").strip()
+        if not q or len(q) > max_len or q.lower() == failed:
+            continue
+        counts[q] = counts.get(q, 0) + 1
+    if not counts:
+        return None
+    return min(counts, key=lambda q: (-counts[q], len(q)))
+
+def _pick_reflection(candidates, last_search_query):
+    """Same as _pick_query, over run_reflection outputs; falls back to the first boxed answer."""
+    new_q = _pick_query([c["new_query"] for c in candidates], last_search_query)
+    if new_q:
+        return next(c for c in candidates if c["new_query"] and c["new_query"].strip() == new_q)
+    # every sampled query was rejected -> none of them may be run
+    fallback = next((c for c in candidates if c["boxed_answer"]), candidates[0])
+    return {**fallback, "new_query": None}
+
+# ===========================
+#   JUDGE VERDICTS (logprobs)
+# ===========================
+
+# Judge stages get their answer prefix pre-filled in the assistant turn, so the very first
+# generated token already is the verdict: stage -> (answer prefix, positive word, negative word)
+_VERDICTS = {
+    "judge_snippet": ("JUDGEMENT:", " YES", " NO"),
+    "presence_check": ("STATUS:", " PRESENT", " ABSENT"),
+    "judge_content": ("JUDGEMENT:", " YES", " NO"),
+    "hallucination_check": ("JUDGEMENT:", " YES", " NO"),
+}
+_VERDICT_IDS = {}  # (id(tokenizer), stage) -> (positive token id, negative token id) or None
+
+def _verdict_token_ids(tokenizer, stage):
+    """Verdict token ids, or None if the two words aren't distinct single tokens for this tokenizer."""
+    key = (id(tokenizer), stage)
+    if key not in _VERDICT_IDS:
+        _, pos, neg = _VERDICTS[stage]
+        pos_ids = tokenizer.encode(pos, add_special_tokens=False)
+        neg_ids = tokenizer.encode(neg, add_special_tokens=False)
+        # e.g. SentencePiece splits " YES" / " NO" into a shared "▁" piece + the word
+        usable = len(pos_ids) == 1 and len(neg_ids) == 1 and pos_ids != neg_ids
+        _VERDICT_IDS[key] = (pos_ids[0], neg_ids[0]) if usable else None
+    return _VERDICT_IDS[key]
+
+def _read_verdict(tokenizer, stage, completion):
+    """True/False from the first generated token's logprobs, or None (-> parse the text)."""
+    ids = _verdict_token_ids(tokenizer, stage)
+    if not completion.logprobs or ids is None:
+        return None
+    pos_id, neg_id = ids
+    first = completion.logprobs[0]
+    pos, neg = first.get(pos_id), first.get(neg_id)
+    if pos is None and neg is None:
+        return None
+    if neg is None:
+        return True
+    if pos is None:
+        return False
+    return pos.logprob >= neg.logprob
+
+# Judges answer on one line; ending there stops decode right after the verdict (+ reason).
+_JUDGE_STOP = ["\n"]
+
+# After the pre-filled "JUDGEMENT:", only these continuations can be decoded.
+_JUDGE_REASON_REGEX = r" (YES|NO \| Reason: [^\n]{1,200})"
+
+def _judge_params(n, max_tokens):
+    # Greedy: a yes/no gate only needs the verdict token (plus a one-line reason for NO).
+    return SamplingParams(
+        n=n,
+        max_tokens=max_tokens,
+        temperature=0.0,
+        logprobs=5,
+        stop=_JUDGE_STOP,
+        guided_decoding=GuidedDecodingParams(regex=_JUDGE_REASON_REGEX),
+    )
+
+def _verdict_only_params(tokenizer, stage, n):
+    # Boolean gates: mask every token but the two verdict tokens, so one decode step is enough.
+    ids = _verdict_token_ids(tokenizer, stage)
+    if ids is None:
+        # No single-token verdicts for this tokenizer: constrain the text to the two words instead.
+        _, pos, neg = _VERDICTS[stage]
+        return SamplingParams(
+            n=n,
+            max_tokens=8,
+            temperature=0.0,
+            stop=_JUDGE_STOP,
+            guided_decoding=GuidedDecodingParams(choice=[pos, neg]),
+        )
+    return SamplingParams(
+        n=n,
+        max_tokens=1,
+        temperature=0.0,
+        logprobs=2,
+        allowed_token_ids=list(ids),
+    )
+
+# stage name -> (prompt builder, sampling params factory, response parser)
+_STAGES = {
+    "judge_snippet": (
+        _prompt_judge_snippet,
+        lambda tokenizer, n: _judge_params(n, max_tokens=64),
+        _parse_judge_snippet,
+    ),
+    "judge_snippet_reflect": (
+        _prompt_judge_snippet_reflect,
+        lambda tokenizer, n: SamplingParams(
+            n=n,
+            max_tokens=_json_token_budget(JUDGE_SNIPPET_REFLECT_SCHEMA),
+            temperature=0.0,
+            stop=_JUDGE_STOP,
+            # single-line JSON: no whitespace runs between fields to burn decode steps on
+            guided_decoding=GuidedDecodingParams(json=JUDGE_SNIPPET_REFLECT_SCHEMA, whitespace_pattern=r" ?"),
+        ),
+        _parse_judge_snippet_reflect,
+    ),
+    "reflection_query": (
+        _prompt_reflection_query,
+        lambda tokenizer, n: SamplingParams(n=n, max_tokens=100, temperature=0.7),
+        _parse_reflection_query,
+    ),
+    "presence_check": (
+        _prompt_presence_check,
+        lambda tokenizer, n: _verdict_only_params(tokenizer, "presence_check", n),
+        _parse_presence_check,
+    ),
+    "refine_extraction": (
+        _prompt_refine_extraction,
+        # Increase max_tokens slightly to allow for a full explanation
+        lambda tokenizer, n: SamplingParams(n=n, max_tokens=1500, temperature=0.5),
+        _parse_refine_extraction,
+    ),
+    "judge_content": (
+        _prompt_judge_content,
+        lambda tokenizer, n: _judge_params(n, max_tokens=64),
+        _parse_judge_content,
+    ),
+    "reflection_content": (
+        _prompt_reflection_content,
+        lambda tokenizer, n: SamplingParams(n=n, max_tokens=300, temperature=0.7),
+        _parse_reflection_content,
+    ),
+    "hallucination_check": (
+        _prompt_hallucination_check,
+        lambda tokenizer, n: _verdict_only_params(tokenizer, "hallucination_check", n),
+        _parse_hallucination_check,
+    ),
+    "reflection": (
+        _prompt_reflection,
+        lambda tokenizer, n: SamplingParams(
+            n=n,
+            max_tokens=512,
+            temperature=0.7,
+            stop=[END_SEARCH_QUERY, tokenizer.eos_token],
+            include_stop_str_in_output=True,
+        ),
+        None,  # parsed with the caller's last_search_query, see run_batch
+    ),
+}
+
+# Stages decoded with temperature=0: identical prompts share one n=1 request and its output.
+_GREEDY_STAGES = set(_VERDICTS) | {"judge_snippet_reflect"}
+
+_SAMPLING_CACHE = {}  # (id(tokenizer), stage, n) -> SamplingParams
+
+def _sampling_params(tokenizer, stage, n):
+    """Builds (and validates) each stage's SamplingParams / stop list once; vLLM copies per request."""
+    key = (id(tokenizer), stage, n)
+    if key not in _SAMPLING_CACHE:
+        _SAMPLING_CACHE[key] = _STAGES[stage][1](tokenizer, n)
+    return _SAMPLING_CACHE[key]
+
+# ===========================
+#    LOGIC FUNCTIONS
+# ===========================
+
+def run_batch(llm, tokenizer, calls):
+    """
+    Runs many gate/reflection calls with ONE llm.generate so vLLM can co-schedule them.
+
+    Args:
+        calls (dict): {seq_id: (stage_name, kwargs)}, where kwargs are the arguments of the
+            matching run_<stage_name> function (without llm/tokenizer). Stages may be mixed;
+            each prompt gets its own SamplingParams. "num_candidates" (reflection_query and
+            reflection only) samples n outputs from one prefill and keeps the best one.
+
+    Returns:
+        dict: {seq_id: result of run_<stage_name>}
+    """
+    if not calls:
+        return {}
+
+    # Identical prompts (e.g. several seqs on the same question and query) are submitted once:
+    # greedy stages share the one output, sampled stages ask for the summed n instead.
+    groups = {}  # (stage, prompt) -> [(seq_id, n), ...]
+    for seq_id, (stage, kwargs) in calls.items():
+        kwargs = dict(kwargs)
+        n = kwargs.pop("num_candidates", 1) or 1
+        prompt = _chat(tokenizer, _STAGES[stage][0](tokenizer, **kwargs))
+        if stage in _VERDICTS:
+            prompt += _VERDICTS[stage][0]
+        groups.setdefault((stage, prompt), []).append((seq_id, n))
+
+    # Sorted submission keeps prompts that share a prefix (same question / judge feedback)
+    # next to each other, so vLLM's automatic prefix caching can reuse their prefill.
+    keys = sorted(groups, key=lambda k: k[1])
+    prompts, params = [], []
+    for stage, prompt in keys:
+        n = 1 if stage in _GREEDY_STAGES else sum(m for _, m in groups[(stage, prompt)])
+        prompts.append(prompt)
+        params.append(_sampling_params(tokenizer, stage, n))
+
+    # One batched (Rust) tokenizer call; vLLM then skips per-request tokenization on the engine.
+    # The chat template already carries any special tokens, so none are added here.
+    prompt_token_ids = tokenizer(prompts, add_special_tokens=False, padding=False)["input_ids"]
+    outputs = llm.generate(
+        [{"prompt_token_ids": ids} for ids in prompt_token_ids],
+        sampling_params=params,
+    )
+
+    completions = {}  # seq_id -> its CompletionOutputs
+    for key, out in zip(keys, outputs):
+        offset = 0
+        for seq_id, n in groups[key]:
+            if key[0] in _GREEDY_STAGES:
+                completions[seq_id] = out.outputs
+            else:
+                completions[seq_id] = out.outputs[offset:offset + n]
+                offset += n
+
+    results = {}
+    for seq_id, (stage, kwargs) in calls.items():
+        responses = [o.text for o in completions[seq_id]]
+        if stage == "reflection":
+            last_q = kwargs["last_search_query"]
+            results[seq_id] = _pick_reflection([_parse_reflection(r, last_q) for r in responses], last_q)
+        elif stage == "judge_snippet_reflect":
+            ok, reason, new_q = _STAGES[stage][2](responses[0])
+            results[seq_id] = (ok, reason, _pick_query([new_q], kwargs["query"]))
+        elif stage == "reflection_query":
+            parse = _STAGES[stage][2]
+            results[seq_id] = _pick_query([parse(r) for r in responses], kwargs["failed_query"])
+        elif stage in _VERDICTS:
+            verdict = _read_verdict(tokenizer, stage, completions[seq_id][0])
+            results[seq_id] = _STAGES[stage][2](_VERDICTS[stage][0] + responses[0], verdict)
+        else:
+            results[seq_id] = _STAGES[stage][2](responses[0])
+    return results
+
+def _run_one(llm, tokenizer, stage, **kwargs):
+    return run_batch(llm, tokenizer, {0: (stage, kwargs)})[0]
+
+def run_judge_snippet(llm, tokenizer, question, history, query, results):
+    """Gate 1: Checks search snippet relevance."""
+    return _run_one(llm, tokenizer, "judge_snippet",
+                    question=question, history=history, query=query, results=results)
+
+def run_reflection_query(llm, tokenizer, question, history, failed_query, failure_reason, num_candidates=1):
+    """Gate 1 Reflector: Generates new query (best of num_candidates samples)."""
+    return _run_one(llm, tokenizer, "reflection_query",
+                    question=question, history=history,
+                    failed_query=failed_query, failure_reason=failure_reason,
+                    num_candidates=num_candidates)
+
+def run_judge_snippet_and_reflect(llm, tokenizer, question, history, query, results):
+    """
+    Gate 1 + Gate 1 Reflector fused into one call (JSON-constrained output).
+
+    Returns:
+        tuple: (is_relevant, reason, new_query), reason/new_query are None when relevant.
+    """
+    return _run_one(llm, tokenizer, "judge_snippet_reflect",
+                    question=question, history=history, query=query, results=results)
+
+def run_presence_check(llm, tokenizer, search_query, document_text):
+    """Checks if info exists in the batch of docs (Boolean check)."""
+    return _run_one(llm, tokenizer, "presence_check",
+                    search_query=search_query, document_text=document_text)
+
+def run_refine_extraction(llm, tokenizer, search_query, document_text):
+    """Forces a re-read of the documents."""
+    return _run_one(llm, tokenizer, "refine_extraction",
+                    search_query=search_query, document_text=document_text)
+
+def run_judge_content(llm, tokenizer, question, search_query, history, extracted_info):
+    """Gate 2: Checks content sufficiency."""
+    return _run_one(llm, tokenizer, "judge_content",
+                    question=question, search_query=search_query,
+                    history=history, extracted_info=extracted_info)
+
+def run_reflection_content(llm, tokenizer, question, search_query, extracted_info, failure_reason):
+    """Gate 2 Reflector: Generates search direction."""
+    return _run_one(llm, tokenizer, "reflection_content",
+                    question=question, search_query=search_query,
+                    extracted_info=extracted_info, failure_reason=failure_reason)
+
+def run_hallucination_check(llm, tokenizer, question, final_answer):
+    """Post-Hoc Check: Checks for uncited claims."""
+    return _run_one(llm, tokenizer, "hallucination_check",
+                    question=question, final_answer=final_answer)
+
+def run_reflection(llm, tokenizer, question, current_reasoning, judge_prompt,
+                   last_search_query, search_results_preview, remaining_searches, num_candidates=1):
+    """
+    Search-o1 self-reflection after a judged search (best of num_candidates samples).
+
+    Returns:
+        dict: {"new_query": str or None, "boxed_answer": str or None, "raw_output": str}
+    """
+    return _run_one(llm, tokenizer, "reflection",
+                    question=question, current_reasoning=current_reasoning,
+                    judge_prompt=judge_prompt, last_search_query=last_search_query,
+                    search_results_preview=search_results_preview,
+                    remaining_searches=remaining_searches,
+                    num_candidates=num_candidates)
@@ -9,6 +9,7 @@ import torch
 import string
 from typing import Optional, Tuple, List, Dict
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 from transformers import AutoTokenizer
 from vllm import LLM, SamplingParams
@@ -38,12 +39,14 @@ from prompts import (
 )
 from reflection import (
     run_judge_snippet,
+    run_judge_snippet_and_reflect,
     run_reflection_query,
     run_judge_content,
     run_reflection_content,
     run_presence_check,
     run_refine_extraction,
     run_hallucination_check,
+    run_batch,
 )
 # dummy judge funtion
 def judge_search(*, search_query: str, results: dict, seq: dict):
@@ -159,6 +162,20 @@ def parse_args():
         help="Path to the pre-trained model."
     )
 
+    parser.add_argument(
+        '--speculative_model',
+        type=str,
+        default=None,
+        help="Optional small draft model for speculative decoding (e.g. a 1B model for a 7B main model)."
+    )
+
+    parser.add_argument(
+        '--num_speculative_tokens',
+        type=int,
+        default=5,
+        help="Number of draft tokens proposed per step when --speculative_model is set."
+    )
+
     # Sampling parameters
     parser.add_argument(
         '--temperature',
@@ -224,6 +241,8 @@ def main():
     top_k = args.top_k
     max_doc_len = args.max_doc_len
     model_path = args.model_path
+    speculative_model = args.speculative_model
+    num_speculative_tokens = args.num_speculative_tokens
     temperature = args.temperature
     top_p = args.top_p
     top_k_sampling = args.top_k_sampling
@@ -311,10 +330,17 @@ def main():
     os.makedirs(output_dir, exist_ok=True)
 
     # Initialize the LLM
+    # A draft model speeds up the long free-form decodes (refine extraction, reasoning turns);
+    # it is transparent to every llm.generate call site.
+    spec_kwargs = {}
+    if speculative_model:
+        spec_kwargs = dict(speculative_model=speculative_model, num_speculative_tokens=num_speculative_tokens)
     llm = LLM(
         model=model_path,
         tensor_parallel_size=torch.cuda.device_count(),
         gpu_memory_utilization=0.95,
+        enable_prefix_caching=True,  # reflection/judge prompts share long prefixes
+        **spec_kwargs,
     )
 
     # ---------------------- Data Loading ----------------------
@@ -530,6 +556,24 @@ def main():
 
         return new_reasoning_steps
 
+    # ---------------------- Reflection Search Helper ----------------------
+    MAX_RETRIES = 5
+    REFLECTION_CANDIDATES = 3  # sampled with one prefill (SamplingParams n=...)
+
+    def _run_search_with_cache(q: str):
+        if q in search_cache:
+            print(f'Using cached search results for query: "{q}"')
+            return search_cache[q]
+        try:
+            r = bing_web_search(q, bing_subscription_key, bing_endpoint, market='en-US', language='en')
+            search_cache[q] = r
+            print(f'Executed and cached search for query: "{q}"')
+            return r
+        except Exception as e:
+            print(f"Error during search query '{q}': {e}")
+            search_cache[q] = {}
+            return {}
+
     # ---------------------- Initialize Collection Structure ----------------------
     # Initialize a list to collect batch outputs
     batch_output_records = []
@@ -562,6 +606,9 @@ def main():
             url_snippets = {}
             url_sequence_map = {}  # Map URL to list of sequences needing it
 
+            # Searches executed this turn, reflected on (batched) before page fetching
+            pending_searches = []
+
             # Process each sequence and collect URLs
             for seq, out in zip(sequences_needing_generation, outputs):
                 text = out.outputs[0].text
@@ -590,30 +637,6 @@ def main():
                                 search_cache[search_query] = {}
                                 results = {}
                     
-                        # reflection here? Use judgement and reflection. If judge said we need a reflection, we run the reflection
-                        # ================= Reflection (LLM-powered) =================
-                        # >>> ADD/REPLACE START: Judge + Reflection right after results exist
-
-                        MAX_RETRIES = 5
-
-                        def _run_search_with_cache(q: str):
-                            if q in search_cache:
-                                print(f'Using cached search results for query: "{q}"')
-                                return search_cache[q]
-                            try:
-                                r = bing_web_search(q, bing_subscription_key, bing_endpoint, market='en-US', language='en')
-                                search_cache[q] = r
-                                print(f'Executed and cached search for query: "{q}"')
-                                return r
-                            except Exception as e:
-                                print(f"Error during search query '{q}': {e}")
-                                search_cache[q] = {}
-                                return {}
-
-                        # IMPORTANT:
-                        # We already have `results` from the initial search above (outside this block).
-                        # So we should NOT re-search the same query here.
-
                         # Count this initial executed search (important!)
                         if search_query not in seq["executed_search_queries"]:
                             seq["executed_search_queries"].add(search_query)
@@ -633,116 +656,16 @@ def main():
                             "judge_prompt": judge_prompt,
                         })
 
-                        # 2) Only do reflection/refine if judge says we should
-                        #    (This is what you wanted: keep a dummy judge interface for future merge.)
-                        if should_reflect and seq.get("reflection_count", 0) < seq.get("max_reflection_turns", 1):
-                            attempt = 0
-                            while attempt < MAX_RETRIES and seq["search_count"] < MAX_SEARCH_LIMIT:
-                                attempt += 1
-
-                                # Use your reflection module to propose ONE new query (or boxed answer)
-                                remaining_searches = max(0, MAX_SEARCH_LIMIT - seq.get("search_count", 0))
-                                search_results_preview = extract_relevant_info(results)[:3]  # short preview to control length
-
-                                new_q = run_reflection(
-                                    llm,
-                                    tokenizer,
-                                    question=seq['item']['Question'],
-                                    current_reasoning=seq['history'][-1] if seq['history'] else "",
-                                    judge_prompt=judge_prompt,
-                                    last_search_query=search_query,
-                                    search_results_preview=search_results_preview,
-                                    remaining_searches=remaining_searches,
-                                )
-
-                                seq.setdefault("reflection_trace", [])
-                                seq["reflection_trace"].append({
-                                    "attempt": attempt,
-                                    "old_query": search_query,
-                                    "judge_prompt": judge_prompt,
-                                    "new_query": new_q,
-                                })
-
-                                if not new_q:
-                                    break
-                                if new_q == search_query:
-                                    # No change -> stop to avoid loops
-                                    break
-                                if new_q in seq["executed_search_queries"]:
-                                    # already executed -> stop to avoid loops
-                                    break
-
-                                # Execute the new query
-                                search_query = new_q
-                                results = _run_search_with_cache(search_query)
-
-                                # Count this new unique query
-                                seq["executed_search_queries"].add(search_query)
-                                seq["search_count"] = seq.get("search_count", 0) + 1
-
-                                # Optional: update judge_prompt for next attempt (keep interface stable)
-                                should_reflect, judge_prompt = judge_search(
-                                    search_query=search_query,
-                                    results=results,
-                                    seq=seq
-                                )
-                                seq["judge_trace"].append({
-                                    "search_query": search_query,
-                                    "should_reflect": bool(should_reflect),
-                                    "judge_prompt": judge_prompt,
-                                })
-
-                                if not should_reflect:
-                                    break
-
-                            seq["reflection_count"] = seq.get("reflection_count", 0) + 1
-
-                        # >>> ADD/REPLACE END
-
-
-                        # Extract relevant information from Bing search results
-                        relevant_info = extract_relevant_info(results)[:top_k]
-                        seq['relevant_info'] = relevant_info
-
-                        # Extract URLs and snippets
-                        urls_to_fetch = [it['url'] for it in relevant_info]
-                        snippets = {info['url']: info['snippet'] for info in relevant_info if 'snippet' in info}
-
-                        # Filter URLs that are not cached
-                        urls_to_fetch_filtered = [u for u in urls_to_fetch if u not in url_cache]
-                        cached_urls = [u for u in urls_to_fetch if u in url_cache]
-
-                        # Store info for all_urls_to_fetch and url_snippets
-                        for url in urls_to_fetch_filtered:
-                            all_urls_to_fetch.add(url)
-                            url_snippets[url] = snippets.get(url, "")
-
-                        all_reasoning_steps = seq['output']
-                        all_reasoning_steps = all_reasoning_steps.replace('\n\n', '\n').split("\n")
-
-                        truncated_prev_reasoning = ""
-                        for i, step in enumerate(all_reasoning_steps):
-                            truncated_prev_reasoning += f"Step {i + 1}: {step}\n\n"
-
-                        prev_steps = truncated_prev_reasoning.split('\n\n')
-                        if len(prev_steps) <= 5:
-                            truncated_prev_reasoning = '\n\n'.join(prev_steps)
-                        else:
-                            truncated_prev_reasoning = ''
-                            for i, step in enumerate(prev_steps):
-                                if i == 0 or i >= len(prev_steps) - 4 or BEGIN_SEARCH_QUERY in step or BEGIN_SEARCH_RESULT in step:
-                                    truncated_prev_reasoning += step + '\n\n'
-                                else:
-                                    if truncated_prev_reasoning[-len('\n\n...\n\n'):] != '\n\n...\n\n':
-                                        truncated_prev_reasoning += '...\n\n'
-                        truncated_prev_reasoning = truncated_prev_reasoning.strip('\n')
-
-                        # Collect parameters for batch processing
-                        batch_relevant_info.append(relevant_info)
-                        batch_original_questions.append(seq['item']['Question'])
-                        batch_prev_reasonings.append(truncated_prev_reasoning)
-                        batch_search_queries.append(search_query)
-                        batch_sequences.append(seq)
+                        # 2) Reflection (if the judge asks for it) runs batched across all
+                        #    sequences after this loop, so collect the search state here.
+                        pending_searches.append({
+                            "seq": seq,
+                            "search_query": search_query,
+                            "results": results,
+                            "should_reflect": should_reflect,
+                            "judge_prompt": judge_prompt,
+                        })
+
 
 
                     elif seq['search_count'] >= MAX_SEARCH_LIMIT:
@@ -764,6 +687,140 @@ def main():
                     seq['finished'] = True
                     print("Sequence marked as complete.")
 
+            # ================= Reflection (LLM-powered, batched) =================
+            # One run_batch (= one llm.generate) per attempt across every sequence that still
+            # wants to reflect, instead of one generate call per sequence.
+            reflecting = [
+                p for p in pending_searches
+                if p["should_reflect"] and p["seq"].get("reflection_count", 0) < p["seq"].get("max_reflection_turns", 1)
+            ]
+            reflected = list(reflecting)
+            attempt = 0
+            while reflecting and attempt < MAX_RETRIES:
+                attempt += 1
+                reflecting = [p for p in reflecting if p["seq"]["search_count"] < MAX_SEARCH_LIMIT]
+                if not reflecting:
+                    break
+
+                calls = {}
+                for idx, p in enumerate(reflecting):
+                    seq = p["seq"]
+                    # Use your reflection module to propose ONE new query (or boxed answer)
+                    calls[idx] = ("reflection", dict(
+                        question=seq['item']['Question'],
+                        current_reasoning=seq['history'][-1] if seq['history'] else "",
+                        judge_prompt=p["judge_prompt"],
+                        last_search_query=p["search_query"],
+                        search_results_preview=extract_relevant_info(p["results"])[:3],  # short preview to control length
+                        remaining_searches=max(0, MAX_SEARCH_LIMIT - seq.get("search_count", 0)),
+                        num_candidates=REFLECTION_CANDIDATES,
+                    ))
+                print(f"Reflecting on {len(calls)} searches (attempt {attempt})...")
+                reflection_outs = run_batch(llm, tokenizer, calls)
+
+                searching = []
+                for idx, p in enumerate(reflecting):
+                    seq = p["seq"]
+                    new_q = reflection_outs[idx]["new_query"]
+
+                    seq.setdefault("reflection_trace", [])
+                    seq["reflection_trace"].append({
+                        "attempt": attempt,
+                        "old_query": p["search_query"],
+                        "judge_prompt": p["judge_prompt"],
+                        "new_query": new_q,
+                        "boxed_answer": reflection_outs[idx]["boxed_answer"],
+                    })
+
+                    if not new_q:
+                        continue
+                    if new_q in seq["executed_search_queries"]:
+                        # already executed -> stop to avoid loops
+                        continue
+                    searching.append((p, new_q))
+
+                # Execute the new queries concurrently (network-bound; the model waits on these)
+                new_queries = list(dict.fromkeys(q for _, q in searching))
+                with ThreadPoolExecutor(max_workers=max(1, min(16, len(new_queries)))) as executor:
+                    new_results = dict(zip(new_queries, executor.map(_run_search_with_cache, new_queries)))
+
+                still_reflecting = []
+                for p, new_q in searching:
+                    seq = p["seq"]
+                    p["search_query"] = new_q
+                    p["results"] = new_results[new_q]
+
+                    # Count this new unique query
+                    seq["executed_search_queries"].add(new_q)
+                    seq["search_count"] = seq.get("search_count", 0) + 1
+
+                    # Optional: update judge_prompt for next attempt (keep interface stable)
+                    should_reflect, p["judge_prompt"] = judge_search(
+                        search_query=new_q,
+                        results=p["results"],
+                        seq=seq
+                    )
+                    seq["judge_trace"].append({
+                        "search_query": new_q,
+                        "should_reflect": bool(should_reflect),
+                        "judge_prompt": p["judge_prompt"],
+                    })
+
+                    if should_reflect:
+                        still_reflecting.append(p)
+                reflecting = still_reflecting
+
+            for p in reflected:
+                p["seq"]["reflection_count"] = p["seq"].get("reflection_count", 0) + 1
+
+            # Queue the final (possibly reflected) search of each sequence for page fetching
+            for p in pending_searches:
+                seq, search_query, results = p["seq"], p["search_query"], p["results"]
+
+                # Extract relevant information from Bing search results
+                relevant_info = extract_relevant_info(results)[:top_k]
+                seq['relevant_info'] = relevant_info
+
+                # Extract URLs and snippets
+                urls_to_fetch = [it['url'] for it in relevant_info]
+                snippets = {info['url']: info['snippet'] for info in relevant_info if 'snippet' in info}
+
+                # Filter URLs that are not cached
+                urls_to_fetch_filtered = [u for u in urls_to_fetch if u not in url_cache]
+                cached_urls = [u for u in urls_to_fetch if u in url_cache]
+
+                # Store info for all_urls_to_fetch and url_snippets
+                for url in urls_to_fetch_filtered:
+                    all_urls_to_fetch.add(url)
+                    url_snippets[url] = snippets.get(url, "")
+
+                all_reasoning_steps = seq['output']
+                all_reasoning_steps = all_reasoning_steps.replace('\n\n', '\n').split("\n")
+
+                truncated_prev_reasoning = ""
+                for i, step in enumerate(all_reasoning_steps):
+                    truncated_prev_reasoning += f"Step {i + 1}: {step}\n\n"
+
+                prev_steps = truncated_prev_reasoning.split('\n\n')
+                if len(prev_steps) <= 5:
+                    truncated_prev_reasoning = '\n\n'.join(prev_steps)
+                else:
+                    truncated_prev_reasoning = ''
+                    for i, step in enumerate(prev_steps):
+                        if i == 0 or i >= len(prev_steps) - 4 or BEGIN_SEARCH_QUERY in step or BEGIN_SEARCH_RESULT in step:
+                            truncated_prev_reasoning += step + '\n\n'
+                        else:
+                            if truncated_prev_reasoning[-len('\n\n...\n\n'):] != '\n\n...\n\n':
+                                truncated_prev_reasoning += '...\n\n'
+                truncated_prev_reasoning = truncated_prev_reasoning.strip('\n')
+
+                # Collect parameters for batch processing
+                batch_relevant_info.append(relevant_info)
+                batch_original_questions.append(seq['item']['Question'])
+                batch_prev_reasonings.append(truncated_prev_reasoning)
+                batch_search_queries.append(search_query)
+                batch_sequences.append(seq)
+
             # Batch fetch all URLs at once to optimize speed
             if all_urls_to_fetch:
                 print(f"Fetching {len(all_urls_to_fetch)} URLs...")